@@ -21,20 +21,37 @@
 
 import os
 import math
+import functools
+import hashlib
 import argparse
 from bertopic import BERTopic
 import pandas as pd
 import numpy as np
-from sentence_transformers import SentenceTransformer
+import numba
 from umap import UMAP
 import seaborn as sns
 import matplotlib.pyplot as plt
 from collections import defaultdict
-from sklearn.linear_model import LinearRegression
-from .fit_dynamic_topic_model import load_data, get_embeddings
+from .fit_dynamic_topic_model import load_data, get_embeddings, load_embedding_model
 
+os.makedirs('figures', exist_ok=True)
+os.makedirs('models', exist_ok=True)
 
-def load_model(min_cluster_size, n_neighbors, modeldir='models') -> BERTopic:
+
+@functools.lru_cache(maxsize=4)
+def _cached_load_model(model_path, embedding, use_onnx):
+    # models are memoized so that repeated calls in a notebook session
+    # return the same objects instead of reloading the weights; the returned
+    # BERTopic is shared, so update_topics/reduce_topics on it also change
+    # what later load_model calls return (call _cached_load_model.cache_clear()
+    # to reload from disk)
+    embedding_model = load_embedding_model(embedding, use_onnx=use_onnx)
+    topic_model = BERTopic.load(model_path, embedding_model=embedding_model)
+    return topic_model, embedding_model
+
+
+def load_model(min_cluster_size, n_neighbors, modeldir='models',
+               embedding='all-MiniLM-L6-v2', use_onnx=False) -> BERTopic:
     """
     Load model from pickle file
 
@@ -46,6 +63,10 @@ def load_model(min_cluster_size, n_neighbors, modeldir='models') -> BERTopic:
         Minimum cluster size
     n_neighbors : int
         Number of neighbors
+    embedding : str
+        Name of the SentenceTransformer embedding model
+    use_onnx : bool
+        On CPU, run the embedding model through ONNX Runtime
 
     Returns
     -------
@@ -60,15 +81,14 @@ def load_model(min_cluster_size, n_neighbors, modeldir='models') -> BERTopic:
     if not os.path.exists(model_path):
         raise FileNotFoundError(f'Model {model_path} not found')
 
-    embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
-    topic_model = BERTopic.load(model_path, embedding_model=embedding_model)
+    topic_model, embedding_model = _cached_load_model(model_path, embedding, use_onnx)
     print('Loaded model from %s' % os.path.join(model_path, model_name))
     return topic_model, embedding_model, model_name
 
 
 def get_topics_over_time(sentences, years, topic_model, date_cutoff='2001-01-01'):
     print('getting topics over time')
-    timestamps = [pd.to_datetime(f'{year}-01-01') for year in years]
+    timestamps = pd.to_datetime(pd.Series(years).astype(str), format='%Y').tolist()
 
     topics_over_time = topic_model.topics_over_time(sentences, timestamps)
 
@@ -87,8 +107,6 @@ def get_hierarchical_topics(topic_model, sentences, viz=False):
     tree = topic_model.get_topic_tree(hierarchical_topics)
     if viz:
         fig = topic_model.visualize_hierarchy()
-        if not os.path.exists('figures'):
-            os.mkdir('figures')
         fig.write_html('figures/hierarchical_topics.html')
     return hierarchical_topics, tree
 
@@ -99,19 +117,30 @@ def plot_hierarchical_topics(topic_model, embeddings, sentences,
                              save_embeddings=True,
                              umap_nneighbors=20):
 
-    # Reduce dimensionality of embeddings, this step is optional
-    reduced_embeddings = UMAP(n_neighbors=umap_nneighbors, 
-                              n_components=2, 
-                              min_dist=0.0, metric='cosine'
-        ).fit_transform(embeddings)
+    # Reduce dimensionality of embeddings, this step is optional;
+    # the projection is cached on disk keyed by a hash of the embeddings
+    embeddings = np.ascontiguousarray(embeddings)  # no copy if already contiguous
+    embedding_hash = hashlib.sha1(f'{embeddings.shape}-{embeddings.dtype}'.encode())
+    embedding_hash.update(embeddings)  # hashes the buffer without a bytes copy
+    embedding_hash = embedding_hash.hexdigest()
+    umap_file = f"models/umap2d-{embedding_hash[:16]}_nneighbors-{umap_nneighbors}.npy"
+    if os.path.exists(umap_file):
+        print(f'using cached UMAP projection from {umap_file}')
+        reduced_embeddings = np.load(umap_file)
+    else:
+        # no random_state, so that UMAP can parallelize the layout optimization
+        reduced_embeddings = UMAP(n_neighbors=umap_nneighbors, 
+                                  n_components=2, 
+                                  min_dist=0.0, metric='cosine',
+                                  low_memory=True, n_jobs=-1
+            ).fit_transform(embeddings)
+        np.save(umap_file, reduced_embeddings)
 
     # Or, if you have reduced the original embeddings already:
     fig = topic_model.visualize_hierarchical_documents(
         sentences, hierarchical_topics, 
         reduced_embeddings=reduced_embeddings)
 
-    if not os.path.exists('figures'):
-        os.mkdir('figures')
     fig.write_html(f"figures/topic_viz_minclust-{minclust}_nneighbors-{nneighbors}.html")
     reduced_embeddings_df = pd.DataFrame(reduced_embeddings, columns=['C1', 'C2'])
     if save_embeddings:
@@ -127,10 +156,18 @@ def get_representative_docs(model_name):
     return representative_docs
 
 
+def get_topic_name_map(topic_model) -> dict:
+    # map each topic number to the first element of its representation
+    info = topic_model.get_topic_info()
+    return dict(zip(info.Topic.tolist(),
+                    [r[0] for r in info.Representation.tolist()]))
+
+
 def get_top_topics_over_time(topics_over_time, topic_model,
                              ntopics_to_plot=3,
                              filter_global_topic=True,
-                             print_results=False):
+                             print_results=False,
+                             name_map=None):
     
     # get top 3 topics for each year, for plotting
 
@@ -140,21 +177,19 @@ def get_top_topics_over_time(topics_over_time, topic_model,
         topics_over_time_filt = topics_over_time
 
     
-    top_topics = []
-    for year in topics_over_time_filt.Timestamp.unique():
-        year_data = topics_over_time_filt[topics_over_time_filt.Timestamp == year].sort_values(
-            'Probability', ascending=False)
-        if print_results:
+    top_per_year = topics_over_time_filt.sort_values(
+        'Probability', ascending=False).groupby('Timestamp').head(ntopics_to_plot)
+    if print_results:
+        for year, year_data in top_per_year.groupby('Timestamp'):
             print(year)
-            print(year_data[['Topic', 'Words', 'Probability']].head(
-                ntopics_to_plot))
-        top_topics.extend(year_data.Topic[:ntopics_to_plot].tolist())
+            print(year_data[['Topic', 'Words', 'Probability']])
 
-    top_topics = list(set(top_topics))
+    top_topics = top_per_year.Topic.unique().tolist()
 
-    top_topics_over_time = topics_over_time[topics_over_time.Topic.isin(top_topics)]
-    top_topics_over_time['Name'] = [
-        topic_model.get_topic_info(i).Representation[0][0] for i in top_topics_over_time.Topic]
+    top_topics_over_time = topics_over_time[topics_over_time.Topic.isin(top_topics)].copy()
+    if name_map is None:
+        name_map = get_topic_name_map(topic_model)
+    top_topics_over_time['Name'] = top_topics_over_time.Topic.map(name_map)
 
     return top_topics_over_time
 
@@ -163,19 +198,20 @@ def plot_top_topics(topics_over_time, topic_model,
                     top_n_topics=10,
                     ntopics_to_plot=3,
                     use_offsets=True, offset=None,
-                    line_alpha=.5):
+                    line_alpha=.5, name_map=None):
     # Get the top 3 topics for each year
+    if name_map is None:
+        name_map = get_topic_name_map(topic_model)
 
     fig = topic_model.visualize_topics_over_time(topics_over_time, top_n_topics=10, 
                                         normalize_frequency=False, width=800)
-    if not os.path.exists('figures'):
-        os.mkdir('figures')
     fig.write_html(f'figures/topics_over_time_minclust-{minclust}_nneighbors-{nneighbors}.html')
 
     # plot timeseries with annotation
 
     top_topics_over_time = get_top_topics_over_time(topics_over_time, topic_model,
-                                                    ntopics_to_plot=ntopics_to_plot)
+                                                    ntopics_to_plot=ntopics_to_plot,
+                                                    name_map=name_map)
     plt.figure(figsize=(10,5))
     sns.set_palette('colorblind')
     ax = sns.lineplot(x='Timestamp', y='Probability', hue='Name', 
@@ -208,59 +244,80 @@ def plot_top_topics(topics_over_time, topic_model,
             offset[19] = -.002
 
     # Plot line names to the right of each line
-    for i in data_2022.index:
-        topicnum = data_2022.loc[i, 'Topic']
-        topicname = topic_model.get_topic_info(topicnum).Representation[0][0]
-        probability = data_2022.loc[i, 'Probability']
+    for row in data_2022.itertuples(index=False):
+        topicname = name_map[row.Topic]
+        probability = row.Probability
         # allow tweaking of location
-        probability_word = probability + offset[topicnum]
+        probability_word = probability + offset[row.Topic]
         plt.annotate(topicname, xy=(xloc, probability_word), 
                     xytext=(xloc + delta, probability_word), ha='left', va='center')
         plt.plot((xloc, xloc + delta), (probability, probability_word),
                 color='k', alpha=0.5,linewidth=0.5)
     plt.tight_layout()
-    if not os.path.exists('figures'):
-        os.mkdir('figures')
     plt.savefig(f'figures/topics_over_time_minclust-{minclust}_nneighbors-{nneighbors}.png',
                 dpi=300)
 
 
-def get_slopes(top_topics_over_time, topic_model):
-    slopes = {}
-    for topic in top_topics_over_time.Topic.unique():
-        topicdata = top_topics_over_time.query(f'Topic == {topic}')
-        topicdata['year'] = [i.year for i in topicdata.Timestamp.tolist()]
-        lr = LinearRegression()
-        lr.fit(topicdata.year.values.reshape(-1, 1), topicdata.Probability)
-        slopes[topic] = lr.coef_[0]
-
-    # %%
-    slope_df = pd.DataFrame({'topic': slopes.keys()})
-    slope_df['slope'] = [slopes[topic] for topic in slope_df.topic]
-    slope_df['topicname'] = [topic_model.get_topic_info(topic).Representation[0][0] for topic in slope_df.topic]
+def get_slopes(top_topics_over_time, topic_model, name_map=None):
+    # closed-form least-squares slope of probability on year for each topic
+    df = top_topics_over_time.assign(
+        year=top_topics_over_time.Timestamp.dt.year,
+        year_x_prob=lambda d: d.year * d.Probability)
+    g = df.groupby('Topic', sort=False)
+    means = g[['year', 'Probability', 'year_x_prob']].mean()
+    year_var = g.year.var(ddof=0)
+    # topics present in a single year have no trend; LinearRegression gave 0
+    slopes = ((means.year_x_prob - means.year * means.Probability) / year_var).where(
+        year_var > 0, 0.0)
+
+    slope_df = pd.DataFrame({'topic': slopes.index, 'slope': slopes.values})
+    if name_map is None:
+        name_map = get_topic_name_map(topic_model)
+    slope_df['topicname'] = slope_df.topic.map(name_map)
     slope_df = slope_df.sort_values('slope')
     return slope_df
 
 
+@numba.njit(cache=True)
+def _propagate_parents(parents, dist, indptr, children, max_distance, mapping_out):
+    # assign each child topic to the last (highest) parent merged below
+    # max_distance; rows are sorted by parent id
+    for row in range(parents.shape[0]):
+        if dist[row] <= max_distance:
+            for k in range(indptr[row], indptr[row + 1]):
+                mapping_out[children[k]] = parents[row]
+
+    # resolve chains to their root, halving paths along the way
+    for topic in range(mapping_out.shape[0]):
+        x = topic
+        while mapping_out[x] != x:
+            mapping_out[x] = mapping_out[mapping_out[x]]
+            x = mapping_out[x]
+        mapping_out[topic] = x
+
+
 # adapted from https://maartengr.github.io/BERTopic/api/plotting/hierarchical_documents.html#bertopic.plotting._hierarchical_documents.visualize_hierarchical_documents
-def get_clustered_topics(topic_model, level_scale='linear', nr_levels=5):
-  topic_per_doc = topic_model.topics_
+def get_clustered_topics(topic_model, sentences, reduced_embeddings,
+                         hierarchical_topics, level_scale='linear', nr_levels=5,
+                         sample=1):
+  topics_arr = np.asarray(topic_model.topics_)
+  sentences_arr = np.asarray(sentences, dtype=object)
 
+  # sample a fraction of the documents in each topic with 100 or more documents
   indices = []
-  for topic in set(topic_per_doc):
-      s = np.where(np.array(topic_per_doc) == topic)[0]
-      size = len(s) if len(s) < 100 else int(len(s))
+  for topic in set(topics_arr.tolist()):
+      s = np.where(topics_arr == topic)[0]
+      size = len(s) if len(s) < 100 else int(len(s) * sample)
       indices.extend(np.random.choice(s, size=size, replace=False))
   indices = np.array(indices)
 
-  df = pd.DataFrame({"topic": np.array(topic_per_doc)[indices]})
-  df["doc"] = [sentences[index] for index in indices]
-  df["topic"] = [topic_per_doc[index] for index in indices]
-
-
   # Combine data
-  df["x"] = reduced_embeddings.C1
-  df["y"] = reduced_embeddings.C2
+  df = pd.DataFrame({
+      "topic": topics_arr[indices],
+      "doc": sentences_arr[indices],
+      "x": reduced_embeddings.C1.values[indices],
+      "y": reduced_embeddings.C2.values[indices],
+  })
 
   # Create topic list for each level, levels are created by calculating the distance
   distances = hierarchical_topics.Distance.to_list()
@@ -273,30 +330,25 @@ def get_clustered_topics(topic_model, level_scale='linear', nr_levels=5):
   else:
       raise ValueError("level_scale needs to be one of 'log' or 'linear'")
 
+  # Flatten the hierarchy into int arrays, with child topics in CSR layout;
+  # ids are shifted by one so that the outlier topic -1 maps to index 0
+  hierarchy = hierarchical_topics.assign(
+      Parent_ID=hierarchical_topics.Parent_ID.astype(int)).sort_values("Parent_ID")
+  parents = hierarchy.Parent_ID.to_numpy(np.int64) + 1
+  dist = hierarchy.Distance.to_numpy(np.float64)
+  indptr = np.concatenate([[0], np.cumsum(hierarchy.Topics.map(len).to_numpy())]).astype(np.int64)
+  children = np.fromiter((t for topics in hierarchy.Topics for t in topics),
+                         dtype=np.int64, count=indptr[-1]) + 1
+  n_ids = max(parents.max(), children.max(), df.topic.max() + 1) + 1
+
   for index, max_distance in enumerate(max_distances):
 
-      # Get topics below `max_distance`
-      mapping = {topic: topic for topic in df.topic.unique()}
-      selection = hierarchical_topics.loc[hierarchical_topics.Distance <= max_distance, :]
-      selection.Parent_ID = selection.Parent_ID.astype(int)
-      selection = selection.sort_values("Parent_ID")
-
-      for row in selection.iterrows():
-          for topic in row[1].Topics:
-              mapping[topic] = row[1].Parent_ID
-
-      # Make sure the mappings are mapped 1:1
-      mappings = [True for _ in mapping]
-      while any(mappings):
-          for i, (key, value) in enumerate(mapping.items()):
-              if value in mapping.keys() and key != value:
-                  mapping[key] = mapping[value]
-              else:
-                  mappings[i] = False
+      # Map topics to their parent below `max_distance`
+      mapping = np.arange(n_ids, dtype=np.int64)
+      _propagate_parents(parents, dist, indptr, children, max_distance, mapping)
 
       # Create new column
-      df[f"level_{index+1}"] = df.topic.map(mapping)
-      df[f"level_{index+1}"] = df[f"level_{index+1}"].astype(int)
+      df[f"level_{index+1}"] = (mapping[df.topic.to_numpy() + 1] - 1).astype(int)
   return df
 
 
@@ -320,10 +372,11 @@ def plot_first_year():
 
 
     # Plot line names to the right of each line
+    name_map = get_topic_name_map(topic_model)
 
     for i in data_2002.index:
         topicnum = data_2002.loc[i, 'Topic']
-        topicname = topic_model.get_topic_info(topicnum).Representation[0][0]
+        topicname = name_map[topicnum]
         probability = data_2002.loc[i, 'Probability']
         # allow tweaking of location
         probability_word = probability
@@ -339,41 +392,26 @@ def plot_first_year():
 
     # %%
     topics_over_time_extrapolated = data_2022
-    import numpy as np
-    np.random.seed(12345)
-
-    def get_extrapolation(data_2022, extra_sd = 0.01):
-        ntopics = len(data_2022.Topic.unique())
-        extrapolation = {}
-
-        timepoints = []
-        probabilities = []
-        topics = []
-        names = []
-
-        topic_mean_change = np.random.normal(loc=0, scale=0.005, size=ntopics)
+    rng = np.random.default_rng(12345)
 
-        for i, topic in enumerate(data_2022.Topic.unique()):
-            extrapolation[topic] = np.hstack(
-                [data_2022.loc[data_2022.Topic == topic, 'Probability'],
-                np.random.normal(loc=topic_mean_change[i], scale=extra_sd, size=10)])
-            extrapolation[topic] = np.clip(np.cumsum(extrapolation[topic]), 
-                                        a_max=None, a_min=0)
-
-
-            for j, year in enumerate(range(2022, 2033)):
-                timepoints.append(pd.to_datetime(f'{year}-01-01'))
-                probabilities.append(extrapolation[topic][j])
-                topics.append(topic)
-                names.append(topic_model.get_topic_info(topic).Representation[0][0])
+    def get_extrapolation(data_2022, extra_sd = 0.01, n_future=10):
+        ntopics = len(data_2022)
 
+        # random walk from the 2022 value, with a per-topic drift
+        topic_mean_change = rng.normal(loc=0, scale=0.005, size=ntopics)
+        steps = rng.normal(loc=topic_mean_change[:, None], scale=extra_sd,
+                           size=(ntopics, n_future))
+        trajectories = np.clip(
+            np.cumsum(np.hstack([data_2022.Probability.values[:, None], steps]), axis=1),
+            a_max=None, a_min=0)
 
+        years = np.arange(2022, 2023 + n_future)
         extrap_df = pd.DataFrame(
-            {'Topic': topics,
-            'Timestamp': timepoints,
-            'Probability': probabilities,
-            'Name': names
-            }, index=range(len(topics)))
+            {'Topic': np.repeat(data_2022.Topic.values, len(years)),
+            'Timestamp': pd.to_datetime(np.tile(years, ntopics).astype(str), format='%Y'),
+            'Probability': trajectories.ravel(),
+            'Name': np.repeat(data_2022.Topic.map(name_map).values, len(years))
+            })
         return(extrap_df)
 
 
@@ -412,6 +450,8 @@ if __name__ == '__main__':
     argparser.add_argument('--n_neighbors', type=int, default=50)
     argparser.add_argument('--datadir', type=str, default='data')
     argparser.add_argument('--modeldir', type=str, default='models')
+    argparser.add_argument('--use_onnx', action='store_true',
+                           help='run the embedding model with ONNX Runtime on CPU')
     args = argparser.parse_args()
 
     # load the prefitted topic model, generated using fit_dynamic_topic_model.py
@@ -422,24 +462,30 @@ if __name__ == '__main__':
 
     minclust, nneighbors = args.min_cluster_size, args.n_neighbors
 
-    topic_model, embedding_model, model_name = load_model(minclust, nneighbors, args.modeldir)
+    topic_model, embedding_model, model_name = load_model(minclust, nneighbors, args.modeldir,
+                                                          use_onnx=args.use_onnx)
+
+    # reuse the embedding model loaded with the topic model
+    embeddings, embedding_model = get_embeddings(sentences, embedding_model=embedding_model)
 
     topics_over_time = get_topics_over_time(sentences, years, topic_model)
 
     hierarchical_topics, tree = get_hierarchical_topics(topic_model, sentences, viz=False)
 
-    embeddings, embedding_model = get_embeddings(sentences)
-
     fig, reduced_embeddings = plot_hierarchical_topics(
         topic_model, embeddings, sentences, hierarchical_topics,
         args.min_cluster_size, args.n_neighbors)
 
-    top_topics_over_time = get_top_topics_over_time(topics_over_time, topic_model)
+    # topic names are looked up once and shared by the functions below
+    name_map = get_topic_name_map(topic_model)
+
+    top_topics_over_time = get_top_topics_over_time(topics_over_time, topic_model,
+                                                    name_map=name_map)
 
     plot_top_topics(topics_over_time, topic_model, 
-                    minclust, nneighbors)
+                    minclust, nneighbors, name_map=name_map)
     
-    slope_df = get_slopes(top_topics_over_time, topic_model)
+    slope_df = get_slopes(top_topics_over_time, topic_model, name_map=name_map)
     slope_df.to_csv(f'models/{model_name}'.replace('_gpt4', '_slopes.csv'), index=False)    
 
 
@@ -22,6 +22,9 @@
 
 import pickle
 import os
+import hashlib
+import numpy as np
+import torch
 from bertopic import BERTopic
 from bertopic.representation import OpenAI
 from sentence_transformers import SentenceTransformer
@@ -83,18 +86,145 @@ def load_data(datadir='data', minyear=1990, maxyear=2023, verbose=False) -> (lis
     return sentences, years
 
 
-def get_embeddings(sentences, overwrite=False,
-                   model_name='all-MiniLM-L6-v2'):
-    embedding_model = SentenceTransformer(model_name)
-    if os.path.exists('data/embeddings.pkl') and not overwrite:
-        print('using existing embeddings from data/embeddings.pkl')
-        with open('data/embeddings.pkl', 'rb') as f:
-            embeddings = pickle.load(f)
+def cached_encode(sentences, model, cache_path='data/embed_cache.npy',
+                  overwrite=False) -> np.ndarray:
+    """
+    Encode sentences, reusing embeddings cached on disk by sentence hash
+
+    Parameters
+    ----------
+    sentences : list of str
+        Sentences to encode
+    model : SentenceTransformer
+        Embedding model
+    cache_path : str
+        Path to the .npy embedding cache; the hash index is stored
+        alongside it with an .idx.pkl suffix. Sentences are the only key,
+        so each model/precision needs its own cache_path
+    overwrite : bool
+        Discard any existing cache
+
+    Returns
+    -------
+    embeddings : np.ndarray
+        Embeddings of shape (len(sentences), embedding dim), in input order
+
+    """
+
+    cache_stem = os.path.splitext(cache_path)[0]
+    index_path = cache_stem + '.idx.pkl'
+    hashes = [hashlib.sha1(s.encode()).hexdigest() for s in sentences]
+
+    if os.path.exists(cache_path) and os.path.exists(index_path) and not overwrite:
+        with open(index_path, 'rb') as f:
+            hash_index = pickle.load(f)
+        cache = np.load(cache_path, mmap_mode='r')
+        embedding_dim = model.get_sentence_embedding_dimension()
+        if embedding_dim is not None and cache.shape[1] != embedding_dim:
+            raise ValueError(
+                f'{cache_path} holds {cache.shape[1]}-d embeddings but the model '
+                f'produces {embedding_dim}-d embeddings; use a different cache_path '
+                'or overwrite=True')
     else:
-        
-        embeddings = embedding_model.encode(sentences, show_progress_bar=False)
-        with open('data/embeddings.pkl', 'wb') as f:
-            pickle.dump(embeddings, f)
+        hash_index = {}
+        cache = None
+
+    # unique sentences that are not yet in the cache
+    missing = {}
+    for s, h in zip(sentences, hashes):
+        if h not in hash_index and h not in missing:
+            missing[h] = s
+
+    if missing:
+        print(f'encoding {len(missing)} of {len(sentences)} sentences')
+        # encode() already sorts inputs by length before batching, which
+        # keeps padding low, so a larger batch is all that is needed here
+        new_embeddings = model.encode(
+            list(missing.values()), batch_size=128,
+            show_progress_bar=False, convert_to_numpy=True
+        ).astype(np.float32)
+        n_cached = 0 if cache is None else cache.shape[0]
+
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = cache_stem + '.tmp.npy'
+        resized = np.lib.format.open_memmap(
+            tmp_path, mode='w+', dtype=np.float32,
+            shape=(n_cached + len(missing), new_embeddings.shape[1]))
+        if n_cached > 0:
+            resized[:n_cached] = cache
+        resized[n_cached:] = new_embeddings
+        resized.flush()
+        del resized, cache
+        os.replace(tmp_path, cache_path)
+
+        for i, h in enumerate(missing):
+            hash_index[h] = n_cached + i
+        # replace the index atomically too, so an interrupted run never
+        # leaves a truncated pickle behind
+        tmp_index_path = cache_stem + '.tmp.idx.pkl'
+        with open(tmp_index_path, 'wb') as f:
+            pickle.dump(hash_index, f)
+        os.replace(tmp_index_path, index_path)
+        cache = np.load(cache_path, mmap_mode='r')
+    else:
+        print(f'using cached embeddings from {cache_path}')
+
+    return np.asarray(cache[[hash_index[h] for h in hashes]])
+
+
+def load_embedding_model(model_name='all-MiniLM-L6-v2', use_onnx=False) -> SentenceTransformer:
+    """
+    Load a sentence embedding model set up for fast inference
+
+    Parameters
+    ----------
+    model_name : str
+        Name of the SentenceTransformer model
+    use_onnx : bool
+        On CPU, run the model through ONNX Runtime (requires optimum)
+
+    Returns
+    -------
+    embedding_model : SentenceTransformer
+        Embedding model; fp16 on GPU when available
+
+    """
+
+    if torch.cuda.is_available():
+        # load weights directly in fp16 rather than casting after loading
+        return SentenceTransformer(
+            model_name, device='cuda',
+            model_kwargs={'torch_dtype': torch.float16, 'low_cpu_mem_usage': True})
+
+    torch.set_num_threads(os.cpu_count())
+    if use_onnx:
+        return SentenceTransformer(model_name, backend='onnx',
+                                   model_kwargs={'provider': 'CPUExecutionProvider'})
+    return SentenceTransformer(model_name)
+
+
+def get_embedding_cache_path(model_name, embedding_model, datadir='data') -> str:
+    # embeddings differ across models and precisions, so each gets its own cache
+    if getattr(embedding_model, 'backend', 'torch') == 'onnx':
+        dtype = 'onnx'
+    else:
+        dtype = str(next(embedding_model.parameters()).dtype).replace('torch.', '')
+    model_tag = model_name.replace('/', '_')
+    return os.path.join(datadir, f'embed_cache-{model_tag}-{dtype}.npy')
+
+
+def get_embeddings(sentences, overwrite=False,
+                   model_name='all-MiniLM-L6-v2',
+                   cache_path=None, use_onnx=False, embedding_model=None):
+    # an already-loaded embedding_model (named model_name) is reused if given
+    if embedding_model is None:
+        embedding_model = load_embedding_model(model_name, use_onnx=use_onnx)
+    if cache_path is None:
+        cache_path = get_embedding_cache_path(model_name, embedding_model)
+    embeddings = cached_encode(sentences, embedding_model,
+                               cache_path=cache_path, overwrite=overwrite)
     return embeddings, embedding_model
 
 if __name__ == '__main__':
@@ -106,6 +236,8 @@ if __name__ == '__main__':
     argparser.add_argument('--reduce_topics', action='store_true')
     argparser.add_argument('--use_gpt4', action='store_true')
     argparser.add_argument('--overwrite', action='store_true')
+    argparser.add_argument('--use_onnx', action='store_true',
+                           help='run the embedding model with ONNX Runtime on CPU')
     args = argparser.parse_args()
 
 
@@ -121,12 +253,13 @@ if __name__ == '__main__':
     sentences, years = load_data(minyear=1990, maxyear=2023)
 
     # Step 1 - Extract embeddings
-    embeddings, embedding_model = get_embeddings(sentences)
+    embeddings, embedding_model = get_embeddings(sentences, use_onnx=args.use_onnx)
 
     # Step 2 - Reduce dimensionality
     # ala https://maartengr.github.io/BERTopic/faq.html#i-have-too-many-topics-how-do-i-decrease-them
     umap_model = UMAP(
-        n_neighbors=args.n_neighbors, n_components=5, min_dist=0.0, metric='cosine'
+        n_neighbors=args.n_neighbors, n_components=5, min_dist=0.0, metric='cosine',
+        low_memory=True, n_jobs=-1
     )
 
     # Step 3 - Cluster reduced embeddings
@@ -165,7 +298,7 @@ if __name__ == '__main__':
         calculate_probabilities=False
     )
 
-    topics, probs = topic_model.fit_transform(sentences)
+    topics, probs = topic_model.fit_transform(sentences, embeddings=embeddings)
     df = pd.DataFrame({"Document": sentences, "Topic": topics})
 
     # need to exclude embedding model as it causes GPU/CPU conflict
@@ -192,7 +325,7 @@ if __name__ == '__main__':
         topic_model.update_topics(sentences, representation_model=representation_model)
         
         model_name += '_gpt4'
-        topics, probs = topic_model.transform(sentences)
+        topics, probs = topic_model.transform(sentences, embeddings=embeddings)
         df = pd.DataFrame({"Document": sentences, "Topic": topics})
         topic_model.save(
             os.path.join(modeldir, model_name),
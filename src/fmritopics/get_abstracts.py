@@ -3,11 +3,17 @@
 
 import sys
 import os
+import io
 from Bio import Entrez
+from lxml import etree
 import time
 import pickle
+import pandas as pd
+import pyarrow as pa
 from fmrihandbook.utils.pubmed import get_pubmed_query_results  # noqa: E402
-from collections import namedtuple
+from collections import namedtuple, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock
 
 
 Entrez.email = 'poldrack@stanford.edu'
@@ -18,20 +24,72 @@ datadir = 'data'
 if not os.path.exists(datadir):
     os.mkdir(datadir)
 
-pmid_file = os.path.join(datadir, 'fmri_pmids.pkl')
+pmid_file = os.path.join(datadir, 'fmri_pmids.parquet')
+legacy_pmid_file = os.path.join(datadir, 'fmri_pmids.pkl')
+
+
+def write_pmid_file(pmids):
+    pd.DataFrame(
+        [(year, pmid) for year, pmids_year in pmids.items() for pmid in pmids_year],
+        columns=['year', 'pmid']
+    ).to_parquet(pmid_file)
+
+
+# one-time conversion of a PMID list saved by earlier versions as a pickle
+if not os.path.exists(pmid_file) and os.path.exists(legacy_pmid_file):
+    print('converting', legacy_pmid_file, 'to', pmid_file)
+    with open(legacy_pmid_file, 'rb') as f:
+        write_pmid_file(pickle.load(f))
 
 if os.path.exists(pmid_file):
-    with open(pmid_file, 'rb') as f:
-        pmids = pickle.load(f)
+    pmid_df = pd.read_parquet(pmid_file)
+    pmids = pmid_df.groupby('year').pmid.apply(list).to_dict()
 else:
-
-    for year in range(1990, end_year + 1):
+    # space the start of successive requests at least 0.34 s apart, to stay
+    # under NCBI's limit of 3 requests/sec across all threads
+    request_interval = 0.34
+    request_lock = Lock()
+    next_request_time = [time.monotonic()]
+
+    def wait_for_request_slot():
+        with request_lock:
+            now = time.monotonic()
+            start = max(now, next_request_time[0])
+            next_request_time[0] = start + request_interval
+        time.sleep(start - now)
+
+    def fetch_year_pmids(year, maxtries=5):
         query = '("fMRI" OR "functional MRI" OR "functional magnetic resonance imaging") AND (brain OR neural OR neuroscience OR neurological OR psychiatric OR psychology) AND %d[DP]' % year
-        results = get_pubmed_query_results(query, Entrez.email)
-        pmids[year] = [int(i) for i in results['IdList']]
-        print('found %d records for' % len(pmids[year]), year)
-        time.sleep(0.5)
-    pickle.dump(pmids, open(pmid_file, 'wb'))
+        tries = 0
+        while True:
+            wait_for_request_slot()
+            try:
+                results = get_pubmed_query_results(query, Entrez.email)
+                return year, [int(i) for i in results['IdList']]
+            except Exception as e:
+                tries += 1
+                print('retrying', year, e)
+                if tries > maxtries:
+                    raise
+
+    failed_years = {}
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {executor.submit(fetch_year_pmids, year): year
+                   for year in range(1990, end_year + 1)}
+        for future in as_completed(futures):
+            try:
+                year, pmids_year = future.result()
+            except Exception as e:
+                failed_years[futures[future]] = e
+                continue
+            pmids[year] = pmids_year
+            print('found %d records for' % len(pmids_year), year)
+
+    # don't cache an incomplete set of years, since the cache is reused as-is
+    if failed_years:
+        raise RuntimeError('failed to get PMIDs for years %s' % sorted(failed_years))
+    pmids = dict(sorted(pmids.items()))
+    write_pmid_file(pmids)
 
 # %% [markdown]
 # code to retrieve pubmed abstracts for fMRI per year
@@ -43,55 +101,124 @@ else:
 maxtries = 5
 authors = []
 
-# since different terms have different #s of abstracts,
-# only take as many as the minimum
-# to prevent different terms from overwhelming the analyses
-
-retmax = max([len(pmids[k]) for k in pmids])
-
 PMID = namedtuple('PMID', ['pmid', 'year', 'abstract'])
+pmid_schema = pa.schema([
+    ('pmid', pa.int32()),
+    ('year', pa.int16()),
+    ('abstract', pa.large_string()),
+])
+
+# records are written to one parquet file per year, so that memory use
+# stays flat and an interrupted run picks up where it left off
+abstract_dir = os.path.join(datadir, 'abstracts')
+if not os.path.exists(abstract_dir):
+    os.mkdir(abstract_dir)
+
+
+def write_year_records(year, pmid_records):
+    # write to a temporary file first, so that an interrupted write never
+    # leaves a truncated file that would be reused on resume; the leading
+    # dot keeps pd.read_parquet on the directory from picking up leftovers
+    abstract_file = os.path.join(abstract_dir, f'abstracts_{year}.parquet')
+    tmp_file = os.path.join(abstract_dir, f'.abstracts_{year}.parquet.tmp')
+    pd.DataFrame(pmid_records, columns=PMID._fields).to_parquet(
+        tmp_file, compression='zstd', schema=pmid_schema, index=False)
+    os.replace(tmp_file, abstract_file)
+
+
+# one-time conversion of records saved by earlier versions as a single pickle
+# of PMID tuples; years that already have a parquet file are left alone
+legacy_record_file = os.path.join(datadir, 'pmid_records.pkl')
+missing_years = [
+    year for year, pmids_year in pmids.items()
+    if len(pmids_year) > 0
+    and not os.path.exists(os.path.join(abstract_dir, f'abstracts_{year}.parquet'))
+]
+if missing_years and os.path.exists(legacy_record_file):
+    with open(legacy_record_file, 'rb') as f:
+        legacy_records = pickle.load(f)
+    legacy_by_year = defaultdict(list)
+    for r in legacy_records:
+        legacy_by_year[r.year].append(PMID(*r))
+    del legacy_records
+    for year, year_records in sorted(legacy_by_year.items()):
+        if not os.path.exists(os.path.join(abstract_dir, f'abstracts_{year}.parquet')):
+            print('converting records for', year, 'from', legacy_record_file)
+            write_year_records(year, year_records)
+    del legacy_by_year
+
+delay = 0.34  # stay under NCBI's limit of 3 requests/sec
+chunksize = 200
+
+for year, pmids_year in pmids.items():
+    if len(pmids_year) == 0:
+        continue
+    abstract_file = os.path.join(abstract_dir, f'abstracts_{year}.parquet')
+    if os.path.exists(abstract_file):
+        print('reusing records for', year)
+        continue
+    print('getting records for', year)
+
+    # post the ids once, then fetch them in chunks from the history server
+    good_post = False
+    tries = 0
+    while not good_post:
+        try:
+            search_results = Entrez.read(
+                Entrez.epost(db='pubmed', id=','.join(['%d' % i for i in pmids_year]))
+            )
+            webenv = search_results['WebEnv']
+            query_key = search_results['QueryKey']
+            time.sleep(delay)
+            good_post = True
+        except:
+            e = sys.exc_info()[0]
+            print('retrying epost', year, e)
+            tries += 1
+            if tries > maxtries:
+                raise e
 
-if os.path.exists(os.path.join(datadir, 'pmid_records.pkl')):
-    pmid_records = pickle.load(
-        open(os.path.join(datadir, 'pmid_records.pkl'), 'rb')
-    )
-else:
     pmid_records = []
-    delay = 2
-    maxtries = 5
-
-    for year, pmids_year in pmids.items():
-        if len(pmids_year) == 0:
-            continue
-        print('getting records for', year)
+    for start in range(0, len(pmids_year), chunksize):
         good_record = False
         tries = 0
         while not good_record:
             try:
                 handle = Entrez.efetch(
                     db='pubmed',
-                    id=','.join(['%d' % i for i in pmids_year]),
-                    retmax=retmax,
+                    webenv=webenv,
+                    query_key=query_key,
+                    retstart=start,
+                    retmax=chunksize,
                     retmode='xml',
                 )
                 time.sleep(delay)
-                records = Entrez.read(handle)
+                xml = handle.read()
+                handle.close()
+                if isinstance(xml, str):
+                    xml = xml.encode('utf-8')
+
+                # stream-parse the articles, freeing each one once it is read
+                chunk_records = []
+                for _, elem in etree.iterparse(io.BytesIO(xml), tag='PubmedArticle'):
+                    pmid = int(elem.findtext('MedlineCitation/PMID'))
+                    abstract_elem = elem.find('MedlineCitation/Article/Abstract/AbstractText')
+                    if abstract_elem is not None:
+                        abstract = ''.join(abstract_elem.itertext())
+                    else:
+                        abstract = None
+                    chunk_records.append(PMID(pmid, year, abstract))
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
                 good_record = True
             except:
                 e = sys.exc_info()[0]
-                print('retrying', year, e)
+                print('retrying', year, start, e)
                 tries += 1
                 if tries > maxtries:
                     raise e
 
-        for i in records['PubmedArticle']:
-            pmid = int(i['MedlineCitation']['PMID'])
-            if 'Abstract' in i['MedlineCitation']['Article']:
-                abstract = i['MedlineCitation']['Article'][
-                    'Abstract'
-                ]['AbstractText'][0]
-            else:
-                abstract = None
-            pmid_records.append(PMID(pmid, year, abstract))
-
-    pickle.dump(pmid_records, open(os.path.join(datadir, 'pmid_records.pkl'), 'wb'))
+        pmid_records.extend(chunk_records)
+
+    write_year_records(year, pmid_records)
@@ -23,8 +23,8 @@ import nltk
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 import pickle
-from collections import namedtuple
 import os
+import pandas as pd
 from nltk.stem import WordNetLemmatizer
 import gensim
 
@@ -66,14 +66,17 @@ def clean_text(sentences):
 
 # Read the abstracts
 
-PMID = namedtuple('PMID', ['pmid', 'year', 'abstract'])
-
 datadir = 'data'
-recordfile = os.path.join(datadir, 'pmid_records.pkl')
-with open(recordfile, 'rb') as f:
-    pmid_records = pickle.load(f)
+# per-year parquet files written by get_abstracts.py
+abstract_dir = os.path.join(datadir, 'abstracts')
+if not os.path.isdir(abstract_dir) or not any(
+        f.endswith('.parquet') for f in os.listdir(abstract_dir)):
+    raise FileNotFoundError(
+        f'no abstracts found in {abstract_dir}; run get_abstracts.py first '
+        '(it also converts a pmid_records.pkl from earlier versions)')
+pmid_records = pd.read_parquet(abstract_dir, engine='pyarrow')
 
-years = list(set([r.year for r in pmid_records]))
+years = sorted(pmid_records.year.unique().tolist())
 
 
 # %%
@@ -96,12 +99,9 @@ for year in years:
         print('reusing cleaned abstracts for', year)
         continue
     print('getting abstracts for', year)
-    abstracts = []
-    for r in pmid_records:
-        if r.abstract is None:
-            continue
-        if r.year == year:
-            abstracts.append(clean_text([r.abstract]))
+    year_abstracts = pmid_records.loc[
+        (pmid_records.year == year) & pmid_records.abstract.notna(), 'abstract']
+    abstracts = [clean_text([a]) for a in year_abstracts]
     bigram.add_vocab([a[0].split(' ') for a in abstracts])
 
     with open(picklefile, 'wb') as f: